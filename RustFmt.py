@@ -1,28 +1,85 @@
 import sublime
 import sublime_plugin
 import subprocess as sub
+import codecs
+import errno
+import itertools
+import multiprocessing
 import os
+import re
 import sys
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
 from . import difflib
 
 SETTINGS = 'RustFmt.sublime-settings'
 DICT_KEY = 'RustFmt'
 IS_WINDOWS = os.name == 'nt'
+CONFIG_NAMES = ('rustfmt.toml', '.rustfmt.toml')
+# Characters of the buffer read and sent to the subprocess at a time.
+CHUNK_SIZE = 64 * 1024
+VERSION_RE = re.compile(r'(\d+)\.(\d+)\.(\d+)')
+
+# Executable args -> whether it needs "--write-mode display". Probing runs
+# a subprocess, and the installed version doesn't change between saves.
+_legacy_write_mode_cache = {}
+
+# Config lookups are memoized to avoid stat-ing every ancestor directory on
+# every save. Saving a config file from Sublime clears the cache immediately;
+# files created by other means are picked up once the cache expires.
+CONFIG_CACHE_TTL = 30
+_config_cache = {}    # dir -> config path or None
+_discover_cache = {}  # start path -> config path or None
+_config_cache_time = 0
+
+# View id -> change count of the buffer as of its last format. Lets
+# format-on-save skip buffers that haven't been edited since.
+_last_formatted = {}
 
 
 def is_rust_view(view):
+    # Cheap check first: this runs on every save of every file.
+    file_name = view.file_name()
+    if file_name is not None and not file_name.endswith('.rs'):
+        return False
     return view.score_selector(0, 'source.rust') > 0
 
 
-def get_setting(view, key):
+# Settings objects are live, so the cached one reflects later changes.
+# Loaded lazily because the API isn't ready while plugins are imported.
+_package_settings = None
+
+
+def package_settings():
+    global _package_settings
+    if _package_settings is None:
+        _package_settings = sublime.load_settings(SETTINGS)
+    return _package_settings
+
+
+# Returns a function that looks up settings like get_setting, but reads the
+# view's overrides only once. Use it when reading several settings in a row.
+def settings_getter(view):
     global_overrides = view.settings().get(DICT_KEY)
-    if isinstance(global_overrides, dict) and key in global_overrides:
-        return global_overrides[key]
-    return sublime.load_settings(SETTINGS).get(key)
+    if not isinstance(global_overrides, dict):
+        global_overrides = {}
+    settings = package_settings()
+
+    def get(key):
+        if key in global_overrides:
+            return global_overrides[key]
+        return settings.get(key)
 
+    return get
 
-def get_env(view):
-    val = get_setting(view, 'env')
+
+def get_setting(view, key):
+    return settings_getter(view)(key)
+
+
+def get_env(get):
+    val = get('env')
     if val is None:
         return None
     env = os.environ.copy()
@@ -44,35 +101,77 @@ def walk_to_root(path):
     if path is None:
         return
 
+    path = os.path.abspath(path)
+
     if os.path.isdir(path):
         yield path
 
-    while not os.path.samefile(path, os.path.dirname(path)):
-        path = os.path.dirname(path)
+    # For a normalized absolute path, only the root is its own parent.
+    while True:
+        parent = os.path.dirname(path)
+        if parent == path:
+            return
+        path = parent
         yield path
 
 
+def clear_config_cache():
+    global _config_cache_time
+    _config_cache.clear()
+    _discover_cache.clear()
+    _config_cache_time = time.time()
+
+
+# Forgets lookups that could be affected by a config file in this directory.
+def forget_config_dir(dir):
+    _config_cache.pop(dir, None)
+    prefix = os.path.join(dir, '')
+    for path in list(_discover_cache):
+        if path == dir or path.startswith(prefix):
+            _discover_cache.pop(path, None)
+
+
 def config_for_dir(dir):
-    path = os.path.join(dir, 'rustfmt.toml')
-    if os.path.exists(path) and os.path.isfile(path):
-        return path
+    if dir in _config_cache:
+        return _config_cache[dir]
 
-    hidden_path = os.path.join(dir, '.rustfmt.toml')
-    if os.path.exists(hidden_path) and os.path.isfile(hidden_path):
-        return hidden_path
+    config = None
 
-    return None
+    # isfile is False for missing paths, so it's one stat per candidate.
+    for name in CONFIG_NAMES:
+        path = os.path.join(dir, name)
+        if os.path.isfile(path):
+            config = path
+            break
+
+    _config_cache[dir] = config
+    return config
 
 
 def find_config_path(path):
+    if time.time() - _config_cache_time > CONFIG_CACHE_TTL:
+        clear_config_cache()
+
+    if path in _discover_cache:
+        return _discover_cache[path]
+
+    config = None
     for dir in walk_to_root(path):
         config = config_for_dir(dir)
         if config:
-            return config
+            break
 
+    _discover_cache[path] = config
+    return config
 
-def guess_cwd(view):
-    mode = get_setting(view, 'cwd_mode')
+
+def window_folders(view):
+    window = view.window()
+    return window.folders() if window else []
+
+
+def guess_cwd(view, get, folders):
+    mode = get('cwd_mode')
 
     if mode.startswith(':'):
         return mode[1:]
@@ -81,54 +180,136 @@ def guess_cwd(view):
         return None
 
     if mode == 'project_root':
-        if len(view.window().folders()):
-            return view.window().folders()[0]
+        if len(folders):
+            return folders[0]
         return None
 
     if mode == 'auto':
         if view.file_name():
             return os.path.dirname(view.file_name())
-        elif len(view.window().folders()):
-            return view.window().folders()[0]
+        elif len(folders):
+            return folders[0]
+
+
+def needs_legacy_write_mode(args, cwd, env):
+    key = tuple(args)
+    if key in _legacy_write_mode_cache:
+        return _legacy_write_mode_cache[key]
+
+    proc = sub.Popen(
+        args=args + ['--version'],
+        stdout=sub.PIPE,
+        stderr=sub.PIPE,
+        startupinfo=process_startup_info(),
+        cwd=cwd,
+        env=env,
+    )
+    (stdout, _) = proc.communicate()
+
+    match = VERSION_RE.search(stdout.decode('utf-8', 'replace'))
+    legacy = bool(match) and tuple(map(int, match.groups())) < (0, 8, 0)
+    _legacy_write_mode_cache[key] = legacy
+    return legacy
 
 
 def merge_into_view(view, edit, new_src):
-    def subview(start, end):
-        return view.substr(sublime.Region(start, end))
-    diffs = difflib.myers_diffs(subview(0, view.size()), new_src)
+    old_src = view.substr(sublime.Region(0, view.size()))
+    diffs = difflib.myers_diffs(old_src, new_src)
     difflib.cleanup_efficiency(diffs)
+    # Positions in old_src and in the view, which shift apart with each edit.
+    old_len = 0
     merged_len = 0
-    for (op_type, patch) in diffs:
+    # Edits since the last equality, applied together with one call.
+    delete_len = 0
+    insert_parts = []
+    # Trailing dummy equality flushes the last edits.
+    for diff in itertools.chain(diffs, [difflib.Diff(difflib.Ops.EQUAL, '')]):
+        op_type = diff.op
+        patch = diff.text
         patch_len = len(patch)
-        if op_type == difflib.Ops.EQUAL:
-            if subview(merged_len, merged_len+patch_len) != patch:
-                raise Exception("[sublime-rust-fmt] mismatch between diff's source and current content")
-            merged_len += patch_len
-        elif op_type == difflib.Ops.INSERT:
-            view.insert(edit, merged_len, patch)
-            merged_len += patch_len
-        elif op_type == difflib.Ops.DELETE:
-            if subview(merged_len, merged_len+patch_len) != patch:
-                raise Exception("[sublime-rust-fmt] mismatch between diff's source and current content")
-            view.erase(edit, sublime.Region(merged_len, merged_len+patch_len))
-
-
-def run_format(view, input, encoding):
-    exec = get_setting(view, 'executable')
-    args = exec if isinstance(exec, list) else [exec]
-
-    if get_setting(view, 'legacy_write_mode_option'):
+        if op_type == difflib.Ops.INSERT:
+            insert_parts.append(patch)
+            continue
+
+        if old_src[old_len:old_len+patch_len] != patch:
+            raise Exception("[sublime-rust-fmt] mismatch between diff's source and current content")
+        old_len += patch_len
+
+        if op_type == difflib.Ops.DELETE:
+            delete_len += patch_len
+            continue
+
+        insert_text = ''.join(insert_parts)
+        region = sublime.Region(merged_len, merged_len+delete_len)
+        if delete_len and insert_text:
+            view.replace(edit, region, insert_text)
+        elif delete_len:
+            view.erase(edit, region)
+        elif insert_text:
+            view.insert(edit, merged_len, insert_text)
+        merged_len += len(insert_text) + patch_len
+        delete_len = 0
+        insert_parts = []
+
+
+# Writing to a subprocess that already exited raises EPIPE, or EINVAL on
+# Windows, like in subprocess.Popen.communicate.
+def is_closed_pipe(err):
+    return isinstance(err, BrokenPipeError) or (
+        isinstance(err, OSError) and err.errno == errno.EINVAL
+    )
+
+
+# Streams the buffer in chunks, to avoid holding a full copy of it both as
+# a string and as bytes. Runs on its own thread, while the caller reads the
+# output, so neither side can block on a full pipe. Other failures are
+# appended to `errors` for the caller to re-raise, since stdin is closed
+# either way and rustfmt would otherwise format a truncated buffer.
+def write_view(view, stream, encoder, errors):
+    try:
+        size = view.size()
+        for start in range(0, size, CHUNK_SIZE):
+            chunk = view.substr(sublime.Region(start, min(start + CHUNK_SIZE, size)))
+            stream.write(encoder.encode(chunk))
+        stream.write(encoder.encode('', final=True))
+    except Exception as err:
+        # If the subprocess exited early, its exit code reports the problem.
+        if not is_closed_pipe(err):
+            errors.append(err)
+    finally:
+        try:
+            stream.close()
+        except Exception as err:
+            if not is_closed_pipe(err):
+                errors.append(err)
+
+
+def run_format(view, encoding):
+    get = settings_getter(view)
+    exec = get('executable')
+    # Copy, since flags are appended below.
+    args = list(exec) if isinstance(exec, list) else [exec]
+    folders = window_folders(view)
+    cwd = guess_cwd(view, get, folders)
+    env = get_env(get)
+
+    legacy = get('legacy_write_mode_option')
+    if legacy == 'auto':
+        legacy = needs_legacy_write_mode(args, cwd, env)
+    if legacy:
         args += ['--write-mode', 'display']
 
-    if get_setting(view, 'use_config_path'):
-        path = view.file_name() or (
-            len(view.window().folders()) and view.window().folders()[0] or None
-        )
+    if get('use_config_path'):
+        path = view.file_name() or (len(folders) and folders[0] or None)
 
         config = path and find_config_path(path)
         if config:
             args += ['--config-path', config]
 
+    # Stateful codecs such as UTF-16 must not restart on every chunk. Built
+    # here, so an unknown encoding fails before rustfmt is waiting on stdin.
+    encoder = codecs.getincrementalencoder(encoding)()
+
     proc = sub.Popen(
         args=args,
         stdin=sub.PIPE,
@@ -136,17 +317,33 @@ def run_format(view, input, encoding):
         stderr=sub.PIPE,
         startupinfo=process_startup_info(),
         universal_newlines=False,
-        cwd=guess_cwd(view),
-        env=get_env(view),
+        cwd=cwd,
+        env=env,
     )
 
-    (stdout, stderr) = proc.communicate(input=bytes(input, encoding=encoding))
-    (stdout, stderr) = stdout.decode(encoding), stderr.decode(encoding)
+    write_errors = []
+    writer = threading.Thread(target=write_view, args=(view, proc.stdin, encoder, write_errors))
+    writer.start()
+    stderr_chunks = []
+    reader = threading.Thread(target=lambda: stderr_chunks.append(proc.stderr.read()))
+    reader.start()
+    stdout = proc.stdout.read()
+    writer.join()
+    reader.join()
+    proc.stdout.close()
+    proc.stderr.close()
+    proc.wait()
+
+    # The output covers only part of the buffer and must not be applied.
+    if write_errors:
+        raise write_errors[0]
+
+    (stdout, stderr) = stdout.decode(encoding), stderr_chunks[0].decode(encoding)
 
     if proc.returncode != 0:
         err = sub.CalledProcessError(proc.returncode, args)
 
-        if get_setting(view, 'error_messages'):
+        if get('error_messages'):
             msg = str(err)
             if len(stderr) > 0:
                 msg += ':\n' + stderr
@@ -169,37 +366,112 @@ def view_encoding(view):
     return 'UTF-8' if encoding == 'Undefined' else encoding
 
 
+def apply_format(view, edit, stdout):
+    merge_type = get_setting(view, 'merge_type')
+
+    if merge_type == 'diff':
+        merge_into_view(view, edit, stdout)
+
+    elif merge_type == 'replace':
+        position = view.viewport_position()
+        # Replace only the middle part that differs.
+        old_src = view.substr(sublime.Region(0, view.size()))
+        prefix_len = difflib.common_prefix_length(old_src, stdout)
+        suffix_len = difflib.common_suffix_length(old_src[prefix_len:], stdout[prefix_len:])
+        region = sublime.Region(prefix_len, len(old_src) - suffix_len)
+        new_text = stdout[prefix_len:len(stdout) - suffix_len]
+        if not region.empty() or new_text:
+            view.replace(edit, region, new_text)
+        # Works only on main thread, hence lambda and timer.
+        restore = lambda: view.set_viewport_position(position, animate=False)
+        sublime.set_timeout(restore, 0)
+
+    else:
+        raise Exception('[sublime-rust-fmt] unknown merge_type setting: {}'.format(merge_type))
+
+    _last_formatted[view.id()] = view.change_count()
+
+
+def is_formatted(view):
+    return _last_formatted.get(view.id()) == view.change_count()
+
+
+# Runs on a worker thread. The output is applied on the main thread, unless
+# the buffer was edited in the meantime.
+def format_async(view, change_count):
+    stdout = run_format(view=view, encoding=view_encoding(view))
+    args = {'stdout': stdout, 'change_count': change_count}
+    # Edits work only on main thread, hence lambda and timer.
+    apply = lambda: view.run_command('rust_fmt_apply_format', args)
+    sublime.set_timeout(apply, 0)
+
+
 class rust_fmt_format_buffer(sublime_plugin.TextCommand):
     def is_enabled(self):
         return is_rust_view(self.view)
 
-    def run(self, edit):
+    # Formatting runs on the async thread to avoid blocking the UI, unless
+    # the caller needs the buffer formatted before returning, like on save.
+    def run(self, edit, sync=False):
         view = self.view
-        content = view.substr(sublime.Region(0, view.size()))
 
-        stdout = run_format(
-            view=view,
-            input=content,
-            encoding=view_encoding(view),
-        )
+        if sync:
+            stdout = run_format(view=view, encoding=view_encoding(view))
+            apply_format(view, edit, stdout)
+            return
+
+        change_count = view.change_count()
+        sublime.set_timeout_async(lambda: format_async(view, change_count), 0)
 
-        merge_type = get_setting(view, 'merge_type')
 
-        if merge_type == 'diff':
-            merge_into_view(view, edit, stdout)
+class rust_fmt_apply_format(sublime_plugin.TextCommand):
+    def run(self, edit, stdout, change_count):
+        # The buffer was edited while rustfmt was running, the output is stale.
+        if self.view.change_count() != change_count:
+            return
+        apply_format(self.view, edit, stdout)
 
-        elif merge_type == 'replace':
-            position = view.viewport_position()
-            view.replace(edit, sublime.Region(0, view.size()), stdout)
-            # Works only on main thread, hence lambda and timer.
-            restore = lambda: view.set_viewport_position(position, animate=False)
-            sublime.set_timeout(restore, 0)
 
-        else:
-            raise Exception('[sublime-rust-fmt] unknown merge_type setting: {}'.format(merge_type))
+# Formats every modified Rust buffer in the window. rustfmt can't format
+# several unsaved buffers in one invocation, so buffers are formatted by
+# parallel subprocesses instead.
+class rust_fmt_format_project(sublime_plugin.WindowCommand):
+    def modified_views(self):
+        return [view for view in self.window.views() if view.is_dirty() and is_rust_view(view)]
+
+    def is_enabled(self):
+        return len(self.modified_views()) > 0
+
+    def run(self):
+        views = [(view, view.change_count()) for view in self.modified_views()]
+
+        # Each job reports its own failure, so one buffer can't stop the rest.
+        def format_one(view, change_count):
+            try:
+                format_async(view, change_count)
+            except sub.CalledProcessError:
+                # Already reported by run_format.
+                pass
+            except Exception as err:
+                print('[sublime-rust-fmt]: failed to format', view.file_name() or 'buffer', err, file=sys.stderr)
+
+        # The jobs run on the pool's own threads. Nothing waits for them, so
+        # neither the UI nor Sublime's shared async thread is held up.
+        executor = ThreadPoolExecutor(max_workers=multiprocessing.cpu_count())
+        for (view, change_count) in views:
+            executor.submit(format_one, view, change_count)
+        executor.shutdown(wait=False)
 
 
 class rust_fmt_listener(sublime_plugin.EventListener):
     def on_pre_save(self, view):
-        if is_rust_view(view) and get_setting(view, 'format_on_save'):
-            view.run_command('rust_fmt_format_buffer')
+        if is_rust_view(view) and get_setting(view, 'format_on_save') and not is_formatted(view):
+            view.run_command('rust_fmt_format_buffer', {'sync': True})
+
+    def on_post_save(self, view):
+        path = view.file_name()
+        if path and os.path.basename(path) in CONFIG_NAMES:
+            forget_config_dir(os.path.dirname(path))
+
+    def on_close(self, view):
+        _last_formatted.pop(view.id(), None)
@@ -8,22 +8,41 @@ Originally found at http://code.google.com/p/google-diff-match-patch/.
 Edited for clarity and simplicity by Nelo Mitranim, 2017.
 """
 
-import re
-from collections import namedtuple
-
 class Ops(object):
-    EQUAL  = 'EQUAL'
-    INSERT = 'INSERT'
-    DELETE = 'DELETE'
+    EQUAL  = 0
+    INSERT = 1
+    DELETE = 2
+
+class Diff(object):
+    """One operation of a diff. Mutable: the cleanup passes edit diffs in
+    place instead of allocating replacements.
+    """
+    __slots__ = ('op', 'text')
 
-Diff = namedtuple('Diff', ['op', 'text'])
+    def __init__(self, op, text):
+        self.op = op
+        self.text = text
+
+    def __repr__(self):
+        return 'Diff(%r, %r)' % (self.op, self.text)
 
 # Cost of an empty edit operation in terms of edit characters.
 DIFF_EDIT_COST = 4
 
-BLANK_LINE_END = re.compile(r"\n\r?\n$")
+# Replacement blocks found by the line-level diff are rediffed character by
+# character only up to this combined length. Bisecting larger blocks is
+# quadratic in practice and can take seconds; they stay line-level.
+LINE_MODE_REDIFF_MAX = 10000
+
+# Endings and beginnings of text that form a blank line. Matched with
+# str.endswith/startswith, which take a tuple of alternatives.
+BLANK_LINE_END = ("\n\n", "\n\r\n")
 
-BLANK_LINE_START = re.compile(r"^\r?\n\r?\n")
+BLANK_LINE_START = ("\n\n", "\n\r\n", "\r\n\n", "\r\n\r\n")
+
+# Memoized boundary_score results, see cleanup_semantic_lossless.
+BOUNDARY_SCORES = {}
+BOUNDARY_SCORES_MAX = 10000
 
 def myers_diffs(text1, text2, checklines=True):
     """Find the differences between two texts.  Simplifies the problem by
@@ -107,8 +126,8 @@ def compute_diffs(text1, text2, checklines):
                          Diff(Ops.INSERT, longtext[i + len(shorttext):])]
         # Swap insertions for deletions if diff is reversed.
         if len(text1) > len(text2):
-            diffs[0] = diffs[0]._replace(op=Ops.DELETE)
-            diffs[2] = diffs[2]._replace(op=Ops.DELETE)
+            diffs[0].op = Ops.DELETE
+            diffs[2].op = Ops.DELETE
         return diffs
 
     if len(shorttext) == 1:
@@ -139,8 +158,10 @@ def line_mode_diffs(text1, text2):
 
     diffs = myers_diffs(text1, text2, False)
 
-    # Convert the diff back to original text.
-    diffs = [diff._replace(text=''.join(line_list[ord(char)] for char in diff.text)) for diff in diffs]
+    # Convert the diff back to original text. Each character's code point
+    # indexes line_list, so str.translate maps it back in one C-level pass.
+    for diff in diffs:
+        diff.text = diff.text.translate(line_list)
 
     # Eliminate freak matches (e.g. blank lines)
     cleanup_semantic(diffs)
@@ -151,26 +172,40 @@ def line_mode_diffs(text1, text2):
     pointer = 0
     count_delete = 0
     count_insert = 0
-    text_delete = ''
-    text_insert = ''
+    # Edit texts are collected in lists and joined once per block, rather
+    # than concatenated one diff at a time.
+    text_delete = []
+    text_insert = []
+    # Blocks already rediffed by this call. Identical replacements, such as
+    # a line reformatted the same way in several places, are diffed once.
+    rediffs = {}
     while pointer < len(diffs):
         if diffs[pointer].op == Ops.INSERT:
             count_insert += 1
-            text_insert += diffs[pointer].text
+            text_insert.append(diffs[pointer].text)
         elif diffs[pointer].op == Ops.DELETE:
             count_delete += 1
-            text_delete += diffs[pointer].text
+            text_delete.append(diffs[pointer].text)
         elif diffs[pointer].op == Ops.EQUAL:
             # Upon reaching an equality, check for prior redundancies.
             if count_delete >= 1 and count_insert >= 1:
-                # Delete the offending records and add the merged ones.
-                a = myers_diffs(text_delete, text_insert, False)
-                diffs[pointer - count_delete - count_insert : pointer] = a
-                pointer = pointer - count_delete - count_insert + len(a)
+                text_delete = ''.join(text_delete)
+                text_insert = ''.join(text_insert)
+                if len(text_delete) + len(text_insert) <= LINE_MODE_REDIFF_MAX:
+                    # Delete the offending records and add the merged ones.
+                    key = (text_delete, text_insert)
+                    a = rediffs.get(key)
+                    if a is None:
+                        a = rediffs[key] = myers_diffs(text_delete, text_insert, False)
+                    else:
+                        # Diffs are mutable, so repeats get their own copies.
+                        a = [Diff(diff.op, diff.text) for diff in a]
+                    diffs[pointer - count_delete - count_insert : pointer] = a
+                    pointer = pointer - count_delete - count_insert + len(a)
             count_insert = 0
             count_delete = 0
-            text_delete = ''
-            text_insert = ''
+            text_delete = []
+            text_insert = []
 
         pointer += 1
 
@@ -188,16 +223,22 @@ def diff_bisect(text1, text2):
         text2: New string to be diffed.
 
     Returns:
-        List of diff tuples.
+        List of Diff objects.
     """
 
     # Cache the text lengths to prevent multiple calls.
     text1_length = len(text1)
     text2_length = len(text2)
+    # The reverse path walks the texts from the end. Reversing them once lets
+    # it index forward instead of computing negative indices per character.
+    rtext1 = text1[::-1]
+    rtext2 = text2[::-1]
     max_d = (text1_length + text2_length + 1) // 2
     v_offset = max_d
     v_length = 2 * max_d
-    v1 = [-1] * v_length
+    # One spare slot past the end, so both neighbours of any k can be read
+    # unconditionally in the loops below.
+    v1 = [-1] * (v_length + 1)
     v1[v_offset + 1] = 0
     v2 = v1[:]
     delta = text1_length - text2_length
@@ -214,11 +255,12 @@ def diff_bisect(text1, text2):
         # Walk the front path one step.
         for k1 in range(-d + k1start, d + 1 - k1end, 2):
             k1_offset = v_offset + k1
-            if k1 == -d or (k1 != d and
-                    v1[k1_offset - 1] < v1[k1_offset + 1]):
-                x1 = v1[k1_offset + 1]
+            left = v1[k1_offset - 1]
+            right = v1[k1_offset + 1]
+            if k1 == -d or (k1 != d and left < right):
+                x1 = right
             else:
-                x1 = v1[k1_offset - 1] + 1
+                x1 = left + 1
             y1 = x1 - k1
             while (x1 < text1_length and y1 < text2_length and
                          text1[x1] == text2[y1]):
@@ -243,14 +285,15 @@ def diff_bisect(text1, text2):
         # Walk the reverse path one step.
         for k2 in range(-d + k2start, d + 1 - k2end, 2):
             k2_offset = v_offset + k2
-            if k2 == -d or (k2 != d and
-                    v2[k2_offset - 1] < v2[k2_offset + 1]):
-                x2 = v2[k2_offset + 1]
+            left = v2[k2_offset - 1]
+            right = v2[k2_offset + 1]
+            if k2 == -d or (k2 != d and left < right):
+                x2 = right
             else:
-                x2 = v2[k2_offset - 1] + 1
+                x2 = left + 1
             y2 = x2 - k2
             while (x2 < text1_length and y2 < text2_length and
-                         text1[-x2 - 1] == text2[-y2 - 1]):
+                         rtext1[x2] == rtext2[y2]):
                 x2 += 1
                 y2 += 1
             v2[k2_offset] = x2
@@ -285,18 +328,18 @@ def bisect_split_diffs(text1, text2, x, y):
         y: Index of split point in text2.
 
     Returns:
-        List of diff tuples.
+        List of Diff objects.
     """
     text1a = text1[:x]
     text2a = text2[:y]
     text1b = text1[x:]
     text2b = text2[y:]
 
-    # Compute both diffs serially.
+    # Compute both diffs serially, extending the first list in place.
     diffs = myers_diffs(text1a, text2a, False)
-    diffsb = myers_diffs(text1b, text2b, False)
+    diffs.extend(myers_diffs(text1b, text2b, False))
 
-    return diffs + diffsb
+    return diffs
 
 def lines_to_chars(text1, text2):
     """Split two texts into a list of strings.  Reduce the texts to a string
@@ -329,26 +372,22 @@ def lines_to_chars(text1, text2):
         Returns:
             Encoded string.
         """
+        # A single C-level split, with the newlines restored afterwards.
+        # The part after the last newline is only a line if it's not empty.
+        lines = text.split('\n')
+        last = lines.pop()
+        lines = [line + '\n' for line in lines]
+        if last:
+            lines.append(last)
+
         chars = []
-        # Walk the text, pulling out a substring for each line.
-        # text.split('\n') would would temporarily double our memory footprint.
-        # Modifying text would create many large strings to garbage collect.
-        line_start = 0
-        line_end = -1
-        while line_end < len(text) - 1:
-            line_end = text.find('\n', line_start)
-            if line_end == -1:
-                line_end = len(text) - 1
-            line = text[line_start:line_end + 1]
-            line_start = line_end + 1
-
-            if line in line_dict:
-                chars.append(chr(line_dict[line]))
-            else:
+        for line in lines:
+            index = line_dict.get(line)
+            if index is None:
+                index = line_dict[line] = len(line_list)
                 line_list.append(line)
-                line_dict[line] = len(line_list) - 1
-                chars.append(chr(len(line_list) - 1))
-        return ''.join(chars)
+            chars.append(index)
+        return ''.join(map(chr, chars))
 
     chars1 = lines_to_chars_munge(text1)
     chars2 = lines_to_chars_munge(text2)
@@ -367,20 +406,31 @@ def common_prefix_length(text1, text2):
     # Quick check for common null cases.
     if not text1 or not text2 or text1[0] != text2[0]:
         return 0
-    # Binary search.
-    # Performance analysis: http://neil.fraser.name/news/2007/10/09/
-    pointermin = 0
-    pointermax = min(len(text1), len(text2))
-    pointermid = pointermax
-    pointerstart = 0
-    while pointermin < pointermid:
-        if text1[pointerstart:pointermid] == text2[pointerstart:pointermid]:
+    # Quick check for one string being a prefix of the other, compared in
+    # bulk without slicing.
+    length = min(len(text1), len(text2))
+    if text1.startswith(text2) or text2.startswith(text1):
+        return length
+    # Galloping search: compare blocks of doubling size from the start, so the
+    # work is proportional to the common prefix rather than to the texts.
+    pointermin = 1
+    step = 1
+    while pointermin < length:
+        pointermax = min(pointermin + step, length)
+        if text1[pointermin:pointermax] != text2[pointermin:pointermax]:
+            break
+        pointermin = pointermax
+        step *= 2
+    else:
+        return length
+    # Binary search for the mismatch inside the last block.
+    while pointermax - pointermin > 1:
+        pointermid = (pointermin + pointermax) // 2
+        if text1[pointermin:pointermid] == text2[pointermin:pointermid]:
             pointermin = pointermid
-            pointerstart = pointermin
         else:
             pointermax = pointermid
-        pointermid = (pointermax - pointermin) // 2 + pointermin
-    return pointermid
+    return pointermin
 
 def common_suffix_length(text1, text2):
     """Determine the common suffix of two strings.
@@ -395,21 +445,33 @@ def common_suffix_length(text1, text2):
     # Quick check for common null cases.
     if not text1 or not text2 or text1[-1] != text2[-1]:
         return 0
-    # Binary search.
-    # Performance analysis: http://neil.fraser.name/news/2007/10/09/
-    pointermin = 0
-    pointermax = min(len(text1), len(text2))
-    pointermid = pointermax
-    pointerend = 0
-    while pointermin < pointermid:
-        if (text1[-pointermid:len(text1) - pointerend] ==
-                text2[-pointermid:len(text2) - pointerend]):
+    text1_length = len(text1)
+    text2_length = len(text2)
+    length = min(text1_length, text2_length)
+    # Quick check for one string being a suffix of the other.
+    if text1.endswith(text2) or text2.endswith(text1):
+        return length
+    # Galloping search from the end, mirroring common_prefix_length.
+    pointermin = 1
+    step = 1
+    while pointermin < length:
+        pointermax = min(pointermin + step, length)
+        if (text1[text1_length - pointermax:text1_length - pointermin] !=
+                text2[text2_length - pointermax:text2_length - pointermin]):
+            break
+        pointermin = pointermax
+        step *= 2
+    else:
+        return length
+    # Binary search for the mismatch inside the last block.
+    while pointermax - pointermin > 1:
+        pointermid = (pointermin + pointermax) // 2
+        if (text1[text1_length - pointermid:text1_length - pointermin] ==
+                text2[text2_length - pointermid:text2_length - pointermin]):
             pointermin = pointermid
-            pointerend = pointermin
         else:
             pointermax = pointermid
-        pointermid = (pointermax - pointermin) // 2 + pointermin
-    return pointermid
+    return pointermin
 
 def common_overlap(text1, text2):
     """Determine if the suffix of one string is the prefix of another.
@@ -449,7 +511,8 @@ def common_overlap(text1, text2):
         if found == -1:
             return best
         length += found
-        if found == 0 or text1[-length:] == text2[:length]:
+        # Slice only text1; startswith compares against text2 in place.
+        if found == 0 or text2.startswith(text1[-length:]):
             best = length
             length += 1
 
@@ -458,24 +521,31 @@ def cleanup_semantic(diffs):
     equalities.
 
     Args:
-        diffs: List of diff tuples.
+        diffs: List of Diff objects.
     """
+    # An eliminated equality stands for a deletion followed by an insertion of
+    # its text. Rather than splitting it in two mid-scan, which shifts the rest
+    # of the list each time, it's marked with this op and expanded at the end.
+    eliminated = -1
     changes = False
     equalities = []  # Stack of indices where equalities are found.
     lastequality = None  # Always equal to diffs[equalities[-1]].text
     pointer = 0  # Index of current position.
+    # Whether the current eliminated equality is at its insertion half.
+    second_half = False
     # Number of chars that changed prior to the equality.
     (length_insertions1, length_deletions1) = (0, 0)
     # Number of chars that changed after the equality.
     (length_insertions2, length_deletions2) = (0, 0)
     while pointer < len(diffs):
-        if diffs[pointer].op == Ops.EQUAL:  # Equality found.
+        op = diffs[pointer].op
+        if op == Ops.EQUAL:  # Equality found.
             equalities.append(pointer)
             (length_insertions1, length_insertions2) = (length_insertions2, 0)
             (length_deletions1, length_deletions2) = (length_deletions2, 0)
             lastequality = diffs[pointer].text
         else:  # An insertion or deletion.
-            if diffs[pointer].op == Ops.INSERT:
+            if op == Ops.INSERT or second_half:
                 length_insertions2 += len(diffs[pointer].text)
             else:
                 length_deletions2 += len(diffs[pointer].text)
@@ -484,10 +554,8 @@ def cleanup_semantic(diffs):
             if (lastequality and (len(lastequality) <=
                     max(length_insertions1, length_deletions1)) and
                     (len(lastequality) <= max(length_insertions2, length_deletions2))):
-                # Duplicate record.
-                diffs.insert(equalities[-1], Diff(Ops.DELETE, lastequality))
-                # Change second copy to insert.
-                diffs[equalities[-1] + 1] = diffs[equalities[-1] + 1]._replace(op=Ops.INSERT)
+                # Mark the record as a deletion plus an insertion.
+                diffs[equalities[-1]].op = eliminated
                 # Throw away the equality we just deleted.
                 equalities.pop()
                 # Throw away the previous equality (it needs to be reevaluated).
@@ -501,11 +569,25 @@ def cleanup_semantic(diffs):
                 length_insertions1, length_deletions1 = 0, 0
                 length_insertions2, length_deletions2 = 0, 0
                 lastequality = None
+                second_half = False
                 changes = True
+            elif op == eliminated and not second_half:
+                # Visit the same record again as the insertion.
+                second_half = True
+                continue
+            else:
+                second_half = False
         pointer += 1
 
     # Normalize the diff.
     if changes:
+        expanded = []
+        for diff in diffs:
+            if diff.op == eliminated:
+                expanded.append(Diff(Ops.DELETE, diff.text))
+                diff.op = Ops.INSERT
+            expanded.append(diff)
+        diffs[:] = expanded
         cleanup_merge(diffs)
     cleanup_semantic_lossless(diffs)
 
@@ -515,33 +597,40 @@ def cleanup_semantic(diffs):
     # e.g: <del>xxxabc</del><ins>defxxx</ins>
     #   -> <ins>def</ins>xxx<del>abc</del>
     # Only extract an overlap if it is as big as the edit ahead or behind it.
-    pointer = 1
+    # The result is streamed into a new list instead of inserting equalities
+    # into the middle of this one.
+    result = []
+    pointer = 0
     while pointer < len(diffs):
-        if (diffs[pointer - 1].op == Ops.DELETE and
-                diffs[pointer].op == Ops.INSERT):
-            deletion = diffs[pointer - 1].text
-            insertion = diffs[pointer].text
+        if (diffs[pointer].op == Ops.DELETE and pointer + 1 < len(diffs) and
+                diffs[pointer + 1].op == Ops.INSERT):
+            deletion = diffs[pointer].text
+            insertion = diffs[pointer + 1].text
             overlap_length1 = common_overlap(deletion, insertion)
             overlap_length2 = common_overlap(insertion, deletion)
-            if overlap_length1 >= overlap_length2:
-                if (overlap_length1 >= len(deletion) / 2.0 or
-                        overlap_length1 >= len(insertion) / 2.0):
-                    # Overlap found.  Insert an equality and trim the surrounding edits.
-                    diffs.insert(pointer, Diff(Ops.EQUAL, insertion[:overlap_length1]))
-                    diffs[pointer - 1] = Diff(Ops.DELETE, deletion[:len(deletion) - overlap_length1])
-                    diffs[pointer + 1] = Diff(Ops.INSERT, insertion[overlap_length1:])
-                    pointer += 1
+            if overlap_length1 >= overlap_length2 and (
+                    overlap_length1 >= len(deletion) / 2.0 or
+                    overlap_length1 >= len(insertion) / 2.0):
+                # Overlap found.  Insert an equality and trim the surrounding edits.
+                result.append(Diff(Ops.DELETE, deletion[:len(deletion) - overlap_length1]))
+                result.append(Diff(Ops.EQUAL, insertion[:overlap_length1]))
+                result.append(Diff(Ops.INSERT, insertion[overlap_length1:]))
+            elif overlap_length1 < overlap_length2 and (
+                    overlap_length2 >= len(deletion) / 2.0 or
+                    overlap_length2 >= len(insertion) / 2.0):
+                # Reverse overlap found.
+                # Insert an equality and swap and trim the surrounding edits.
+                result.append(Diff(Ops.INSERT, insertion[:len(insertion) - overlap_length2]))
+                result.append(Diff(Ops.EQUAL, deletion[:overlap_length2]))
+                result.append(Diff(Ops.DELETE, deletion[overlap_length2:]))
             else:
-                if (overlap_length2 >= len(deletion) / 2.0 or
-                        overlap_length2 >= len(insertion) / 2.0):
-                    # Reverse overlap found.
-                    # Insert an equality and swap and trim the surrounding edits.
-                    diffs.insert(pointer, Diff(Ops.EQUAL, deletion[:overlap_length2]))
-                    diffs[pointer - 1] = Diff(Ops.INSERT, insertion[:len(insertion) - overlap_length2])
-                    diffs[pointer + 1] = Diff(Ops.DELETE, deletion[overlap_length2:])
-                    pointer += 1
+                result.append(diffs[pointer])
+                result.append(diffs[pointer + 1])
+            pointer += 2
+        else:
+            result.append(diffs[pointer])
             pointer += 1
-        pointer += 1
+    diffs[:] = result
 
 def cleanup_semantic_lossless(diffs):
     """Look for single edits surrounded on both sides by equalities
@@ -549,58 +638,42 @@ def cleanup_semantic_lossless(diffs):
     e.g: The c<ins>at c</ins>ame. -> The <ins>cat </ins>came.
 
     Args:
-        diffs: List of diff tuples.
+        diffs: List of Diff objects.
     """
 
-    def cleanup_semantic_score(one, two):
-        """Given two strings, compute a score representing whether the
-        internal boundary falls on logical boundaries.
-        Scores range from 6 (best) to 0 (worst).
+    def cleanup_semantic_score(text, start, boundary, end):
+        """Given two adjacent substrings of a text, compute a score
+        representing whether the internal boundary falls on logical
+        boundaries.  Scores range from 6 (best) to 0 (worst).
         Closure, but does not reference any external variables.
 
         Args:
-            one: First string.
-            two: Second string.
+            text: String containing both substrings.
+            start: Index where the first substring starts.
+            boundary: Index where the first substring ends and the second starts.
+            end: Index where the second substring ends.
 
         Returns:
             The score.
         """
-        if not one or not two:
+        if start == boundary or boundary == end:
             # Edges are the best.
             return 6
 
-        # Each port of this function behaves slightly differently due to
-        # subtle differences in each language's definition of things like
-        # 'whitespace'.  Since this function's purpose is largely cosmetic,
-        # the choice has been made to use each language's native features
-        # rather than force total conformity.
-        char1 = one[-1]
-        char2 = two[0]
-        non_alpha_numeric_1 = not char1.isalnum()
-        non_alpha_numeric_2 = not char2.isalnum()
-        whitespace1 = non_alpha_numeric_1 and char1.isspace()
-        whitespace2 = non_alpha_numeric_2 and char2.isspace()
-        line_break_1 = whitespace1 and (char1 == "\r" or char1 == "\n")
-        line_break_2 = whitespace2 and (char2 == "\r" or char2 == "\n")
-        blank_line_1 = line_break_1 and BLANK_LINE_END.search(one)
-        blank_line_2 = line_break_2 and BLANK_LINE_START.match(two)
-
-        if blank_line_1 or blank_line_2:
-            # Five points for blank lines.
-            return 5
-        elif line_break_1 or line_break_2:
-            # Four points for line breaks.
-            return 4
-        elif non_alpha_numeric_1 and not whitespace1 and whitespace2:
-            # Three points for end of sentences.
-            return 3
-        elif whitespace1 or whitespace2:
-            # Two points for whitespace.
-            return 2
-        elif non_alpha_numeric_1 or non_alpha_numeric_2:
-            # One point for non-alphanumeric.
-            return 1
-        return 0
+        # The score depends only on the characters at the boundary and on
+        # whether they end or start a blank line, so it's memoized on those.
+        char1 = text[boundary - 1]
+        char2 = text[boundary]
+        blank_line_1 = char1 == "\n" and text.endswith(BLANK_LINE_END, start, boundary)
+        blank_line_2 = ((char2 == "\r" or char2 == "\n") and
+                        text.startswith(BLANK_LINE_START, boundary, end))
+        key = (char1, char2, blank_line_1, blank_line_2)
+        score = BOUNDARY_SCORES.get(key)
+        if score is None:
+            if len(BOUNDARY_SCORES) >= BOUNDARY_SCORES_MAX:
+                BOUNDARY_SCORES.clear()
+            score = BOUNDARY_SCORES[key] = boundary_score(*key)
+        return score
 
     pointer = 1
     # Intentionally ignore the first and last element (don't need checking).
@@ -621,43 +694,94 @@ def cleanup_semantic_lossless(diffs):
                 equality2 = common_string + equality2
 
             # Second, step character by character right, looking for the best fit.
-            best_equality_1 = equality1
-            best_edit = edit
-            best_equality_2 = equality2
-            best_score = (cleanup_semantic_score(equality1, edit) + cleanup_semantic_score(edit, equality2))
-            while edit and equality2 and edit[0] == equality2[0]:
-                equality1 += edit[0]
-                edit = edit[1:] + equality2[0]
-                equality2 = equality2[1:]
-                score = (cleanup_semantic_score(equality1, edit) + cleanup_semantic_score(edit, equality2))
+            # The edit is tracked as a window [edit_start:edit_end] into the
+            # joined text, so a step moves two indices instead of rebuilding
+            # three strings; the best window is sliced out once at the end.
+            text = equality1 + edit + equality2
+            text_length = len(text)
+            edit_start = len(equality1)
+            edit_end = edit_start + len(edit)
+            best_start = edit_start
+            best_score = (cleanup_semantic_score(text, 0, edit_start, edit_end) +
+                          cleanup_semantic_score(text, edit_start, edit_end, text_length))
+            while (edit_start < edit_end < text_length and
+                    text[edit_start] == text[edit_end]):
+                edit_start += 1
+                edit_end += 1
+                score = (cleanup_semantic_score(text, 0, edit_start, edit_end) +
+                         cleanup_semantic_score(text, edit_start, edit_end, text_length))
                 # The >= encourages trailing rather than leading whitespace on edits.
                 if score >= best_score:
                     best_score = score
-                    best_equality_1 = equality1
-                    best_edit = edit
-                    best_equality_2 = equality2
+                    best_start = edit_start
+            best_end = best_start + len(edit)
+            best_equality_1 = text[:best_start]
+            best_edit = text[best_start:best_end]
+            best_equality_2 = text[best_end:]
 
             if diffs[pointer - 1].text != best_equality_1:
                 # We have an improvement, save it back to the diff.
                 if best_equality_1:
-                    diffs[pointer - 1] = diffs[pointer - 1]._replace(text=best_equality_1)
+                    diffs[pointer - 1].text = best_equality_1
                 else:
                     del diffs[pointer - 1]
                     pointer -= 1
-                diffs[pointer] = diffs[pointer]._replace(text=best_edit)
+                diffs[pointer].text = best_edit
                 if best_equality_2:
-                    diffs[pointer + 1] = diffs[pointer + 1]._replace(text=best_equality_2)
+                    diffs[pointer + 1].text = best_equality_2
                 else:
                     del diffs[pointer + 1]
                     pointer -= 1
         pointer += 1
 
+def boundary_score(char1, char2, blank_line_1, blank_line_2):
+    """Score the boundary between two characters for
+    cleanup_semantic_lossless.  Scores range from 5 (best) to 0 (worst).
+
+    Args:
+        char1: Last character before the boundary.
+        char2: First character after the boundary.
+        blank_line_1: Whether the text before the boundary ends with a blank line.
+        blank_line_2: Whether the text after the boundary starts with a blank line.
+
+    Returns:
+        The score.
+    """
+    # Each port of this function behaves slightly differently due to
+    # subtle differences in each language's definition of things like
+    # 'whitespace'.  Since this function's purpose is largely cosmetic,
+    # the choice has been made to use each language's native features
+    # rather than force total conformity.
+    non_alpha_numeric_1 = not char1.isalnum()
+    non_alpha_numeric_2 = not char2.isalnum()
+    whitespace1 = non_alpha_numeric_1 and char1.isspace()
+    whitespace2 = non_alpha_numeric_2 and char2.isspace()
+    line_break_1 = whitespace1 and (char1 == "\r" or char1 == "\n")
+    line_break_2 = whitespace2 and (char2 == "\r" or char2 == "\n")
+
+    if blank_line_1 or blank_line_2:
+        # Five points for blank lines.
+        return 5
+    elif line_break_1 or line_break_2:
+        # Four points for line breaks.
+        return 4
+    elif non_alpha_numeric_1 and not whitespace1 and whitespace2:
+        # Three points for end of sentences.
+        return 3
+    elif whitespace1 or whitespace2:
+        # Two points for whitespace.
+        return 2
+    elif non_alpha_numeric_1 or non_alpha_numeric_2:
+        # One point for non-alphanumeric.
+        return 1
+    return 0
+
 def cleanup_efficiency(diffs):
     """Reduce the number of edits by eliminating operationally trivial
     equalities.
 
     Args:
-        diffs: List of diff tuples.
+        diffs: List of Diff objects.
     """
     changes = False
     equalities = []  # Stack of indices where equalities are found.
@@ -701,7 +825,7 @@ def cleanup_efficiency(diffs):
                 # Duplicate record.
                 diffs.insert(equalities[-1], Diff(Ops.DELETE, lastequality))
                 # Change second copy to insert.
-                diffs[equalities[-1] + 1] = Diff(Ops.INSERT, diffs[equalities[-1] + 1].text)
+                diffs[equalities[-1] + 1].op = Ops.INSERT
                 equalities.pop()  # Throw away the equality we just deleted.
                 lastequality = None
                 if pre_ins and pre_del:
@@ -727,109 +851,139 @@ def cleanup_merge(diffs):
     Any edit section can move as long as it doesn't cross an equality.
 
     Args:
-        diffs: List of diff tuples.
+        diffs: List of Diff objects.
     """
-    diffs.append(Diff(Ops.EQUAL, ''))  # Add a dummy entry at the end.
-    pointer = 0
-    count_delete = 0
-    count_insert = 0
-    text_delete = ''
-    text_insert = ''
-    while pointer < len(diffs):
-        if diffs[pointer].op == Ops.INSERT:
-            count_insert += 1
-            text_insert += diffs[pointer].text
-            pointer += 1
-        elif diffs[pointer].op == Ops.DELETE:
-            count_delete += 1
-            text_delete += diffs[pointer].text
-            pointer += 1
-        elif diffs[pointer].op == Ops.EQUAL:
-            # Upon reaching an equality, check for prior redundancies.
-            if count_delete + count_insert > 1:
-                if count_delete != 0 and count_insert != 0:
-                    # Factor out any common prefixies.
-                    common_length = common_prefix_length(text_insert, text_delete)
-                    if common_length != 0:
-                        x = pointer - count_delete - count_insert - 1
-                        if x >= 0 and diffs[x].op == Ops.EQUAL:
-                            diffs[x] = diffs[x]._replace(text=(diffs[x].text + text_insert[:common_length]))
-                        else:
-                            diffs.insert(0, Diff(Ops.EQUAL, text_insert[:common_length]))
-                            pointer += 1
-                        text_insert = text_insert[common_length:]
-                        text_delete = text_delete[common_length:]
-                    # Factor out any common suffixies.
-                    common_length = common_suffix_length(text_insert, text_delete)
-                    if common_length != 0:
-                        diffs[pointer] = diffs[pointer]._replace(text=(
-                            text_insert[-common_length:] + diffs[pointer].text
-                        ))
-                        text_insert = text_insert[:-common_length]
-                        text_delete = text_delete[:-common_length]
-                # Delete the offending records and add the merged ones.
-                if count_delete == 0:
-                    diffs[pointer - count_insert : pointer] = [Diff(Ops.INSERT, text_insert)]
-                elif count_insert == 0:
-                    diffs[pointer - count_delete : pointer] = [Diff(Ops.DELETE, text_delete)]
+    # Quick check for lists with nothing to merge, such as the single
+    # insertion or deletion returned for many leaves of the bisect recursion.
+    # A lone empty record still goes through the full pass, which drops a
+    # trailing empty equality.
+    if not diffs or (len(diffs) == 1 and diffs[0].text):
+        return
+    # Local aliases, which the loops below look up faster than class attributes.
+    EQUAL = Ops.EQUAL
+    INSERT = Ops.INSERT
+    DELETE = Ops.DELETE
+    # Sweep until a pass makes no shifts.  Both passes stream their records
+    # into a new list, instead of splicing and deleting in place, which
+    # would shift the tail of the list on every merge.
+    while True:
+        diffs.append(Diff(EQUAL, ''))  # Add a dummy entry at the end.
+        result = []
+        pointer = 0
+        count_delete = 0
+        count_insert = 0
+        # Edit texts are collected in lists and joined once per run of edits.
+        text_delete = []
+        text_insert = []
+        while pointer < len(diffs):
+            diff = diffs[pointer]
+            op = diff.op
+            if op == INSERT:
+                count_insert += 1
+                text_insert.append(diff.text)
+            elif op == DELETE:
+                count_delete += 1
+                text_delete.append(diff.text)
+            elif op == EQUAL:
+                # Upon reaching an equality, check for prior redundancies.
+                if count_delete + count_insert > 1:
+                    text_delete = ''.join(text_delete)
+                    text_insert = ''.join(text_insert)
+                    if count_delete != 0 and count_insert != 0:
+                        # Factor out any common prefixies.
+                        common_length = common_prefix_length(text_insert, text_delete)
+                        if common_length != 0:
+                            if result and result[-1].op == EQUAL:
+                                result[-1].text += text_insert[:common_length]
+                            else:
+                                result.append(Diff(EQUAL, text_insert[:common_length]))
+                            text_insert = text_insert[common_length:]
+                            text_delete = text_delete[common_length:]
+                        # Factor out any common suffixies.
+                        common_length = common_suffix_length(text_insert, text_delete)
+                        if common_length != 0:
+                            diff.text = text_insert[-common_length:] + diff.text
+                            text_insert = text_insert[:-common_length]
+                            text_delete = text_delete[:-common_length]
+                    # Replace the offending records with the merged ones.
+                    if count_delete != 0:
+                        result.append(Diff(DELETE, text_delete))
+                    if count_insert != 0:
+                        result.append(Diff(INSERT, text_insert))
+                    result.append(diff)
+                elif count_delete + count_insert == 1:
+                    # A lone edit is kept as it is.
+                    result.append(diffs[pointer - 1])
+                    result.append(diff)
+                elif result and result[-1].op == EQUAL:
+                    # Merge this equality, and any that directly follow it,
+                    # with the previous one.
+                    end = pointer + 1
+                    while end < len(diffs) and diffs[end].op == EQUAL:
+                        end += 1
+                    result[-1].text += ''.join([diff.text for diff in diffs[pointer:end]])
+                    pointer = end - 1
                 else:
-                    diffs[pointer - count_delete - count_insert : pointer] = [
-                            Diff(Ops.DELETE, text_delete),
-                            Diff(Ops.INSERT, text_insert)]
-                pointer = pointer - count_delete - count_insert + 1
-                if count_delete != 0:
-                    pointer += 1
-                if count_insert != 0:
-                    pointer += 1
-            elif pointer != 0 and diffs[pointer - 1].op == Ops.EQUAL:
-                # Merge this equality with the previous one.
-                diffs[pointer - 1] = diffs[pointer - 1]._replace(text=(
-                    diffs[pointer - 1].text + diffs[pointer].text
-                ))
-                del diffs[pointer]
-            else:
-                pointer += 1
+                    result.append(diff)
 
-            count_insert = 0
-            count_delete = 0
-            text_delete = ''
-            text_insert = ''
-
-    if diffs[-1].text == '':
-        diffs.pop()  # Remove the dummy entry at the end.
+                count_insert = 0
+                count_delete = 0
+                text_delete = []
+                text_insert = []
+            pointer += 1
 
-    # Second pass: look for single edits surrounded on both sides by equalities
-    # which can be shifted sideways to eliminate an equality.
-    # e.g: A<ins>BA</ins>C -> <ins>AB</ins>AC
-    changes = False
-    pointer = 1
-    # Intentionally ignore the first and last element (don't need checking).
-    while pointer < len(diffs) - 1:
-        if (diffs[pointer - 1].op == Ops.EQUAL and
-                diffs[pointer + 1].op == Ops.EQUAL):
-            # This is a single edit surrounded by equalities.
-            if diffs[pointer].text.endswith(diffs[pointer - 1].text):
-                # Shift the edit over the previous equality.
-                diffs[pointer] = diffs[pointer]._replace(text=(
-                    diffs[pointer - 1].text + diffs[pointer].text[:-len(diffs[pointer - 1].text)]
-                ))
-                diffs[pointer + 1] = diffs[pointer + 1]._replace(text=(
-                    diffs[pointer - 1].text + diffs[pointer + 1].text
-                ))
-                del diffs[pointer - 1]
-                changes = True
-            elif diffs[pointer].text.startswith(diffs[pointer + 1].text):
-                # Shift the edit over the next equality.
-                diffs[pointer - 1] = diffs[pointer - 1]._replace(text=(
-                    diffs[pointer - 1].text + diffs[pointer + 1].text
-                ))
-                diffs[pointer] = diffs[pointer]._replace(text=(
-                    diffs[pointer].text[len(diffs[pointer + 1].text):] + diffs[pointer + 1].text
-                ))
-                del diffs[pointer + 1]
-                changes = True
-        pointer += 1
+        if result[-1].text == '':
+            result.pop()  # Remove the dummy entry at the end.
+        diffs[:] = result
+
+        # Second pass: look for single edits surrounded on both sides by equalities
+        # which can be shifted sideways to eliminate an equality.
+        # e.g: A<ins>BA</ins>C -> <ins>AB</ins>AC
+        changes = False
+        if len(diffs) < 3:
+            break
+        result = [diffs[0]]
+        pointer = 1
+        # Intentionally ignore the first and last element (don't need checking).
+        while pointer < len(diffs) - 1:
+            previous = result[-1]
+            diff = diffs[pointer]
+            following = diffs[pointer + 1]
+            if previous.op == EQUAL and following.op == EQUAL:
+                # This is a single edit surrounded by equalities.
+                previous_text = previous.text
+                text = diff.text
+                next_text = following.text
+                # An empty equality always matches. Shifting over it changes no
+                # text and only drops it, so the string rebuilding is skipped.
+                if text.endswith(previous_text):
+                    # Shift the edit over the previous equality.
+                    if previous_text:
+                        # An edit equal to the equality keeps its text as is.
+                        if len(text) != len(previous_text):
+                            diff.text = previous_text + text[:-len(previous_text)]
+                        following.text = previous_text + next_text
+                    # The previous equality was moved into the next one.
+                    result[-1] = diff
+                    pointer += 1
+                    changes = True
+                    continue
+                elif text.startswith(next_text):
+                    # Shift the edit over the next equality.
+                    if next_text:
+                        previous.text = previous_text + next_text
+                        if len(text) != len(next_text):
+                            diff.text = text[len(next_text):] + next_text
+                    result.append(diff)
+                    # The next equality was moved into the previous one.
+                    pointer += 2
+                    changes = True
+                    continue
+            result.append(diff)
+            pointer += 1
+        result.extend(diffs[pointer:])
+        diffs[:] = result
 
-    # If shifts were made, the diff needs reordering and another shift sweep.
-    if changes:
-        cleanup_merge(diffs)
+        # If shifts were made, the diff needs reordering and another shift sweep.
+        if not changes:
+            break